@@ -139,12 +139,21 @@ if __name__ == "__main__":  # pragma: nocover
 #
 #   $ pip install scriptloader
 #   $ nosetests --with-scriptloader path/to/script
+#
+# With unittest, setting SCRIPT_TESTINDEX to an index file runs only the tests
+# whose code changed since they last passed (SCRIPT_TESTFULL runs them all):
+#
+#   $ SCRIPT_TESTINDEX=.testindex python -m unittest script
 
 # Override the global logger instance with one from a special "tests"
 # namespace.
 name = log.name
 log = logging.getLogger("%s.tests" % name)
 
+import ast
+import hashlib
+import inspect
+import json
 import os
 import shutil
 import subprocess
@@ -172,6 +181,458 @@ def getpyfile(filename, split=os.path.splitext, exists=os.path.exists):
         sourcefile = filename
     return sourcefile
 
+# The absolute path to this script, resolved before any functional test changes
+# the working directory.
+scriptfile = os.path.abspath(getpyfile(__file__))
+
+
+def sourceblocks(filename):
+    """Hash the functions and classes defined in a source file.
+
+    Returns a tuple (*names*, *hashes*). *names* maps the line number where each
+    function's code begins (as in :attr:`co_firstlineno`) to its dotted name.
+    *hashes* maps each function's dotted name to a hash of its source and each
+    class's dotted name to a hash of its body, in which the functions and
+    classes it defines are represented only by their names. The special name
+    ``<module>`` likewise hashes the module's body. Blank lines, comments and
+    the position of statements don't affect the hashes of classes or the
+    module.
+
+    :param filename: the path to a Python source file.
+    """
+    source = open(filename).read()
+    lines = source.splitlines(True)
+    tree = ast.parse(source, filename)
+    names = {}
+    hashes = {}
+    defs = (ast.FunctionDef, ast.ClassDef)
+
+    def statements(nodes):
+        dumps = [ast.dump(n) for n in nodes if not isinstance(n, defs)]
+        dumps.append("")
+        dumps.extend(sorted([n.name for n in nodes if isinstance(n, defs)]))
+        return hashlib.sha1("\n".join(dumps)).hexdigest()
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                qualname = prefix + child.name
+                hashes[qualname] = statements(
+                    child.bases + child.decorator_list + child.body)
+                visit(child, qualname + ".")
+            elif isinstance(child, ast.FunctionDef):
+                qualname = prefix + child.name
+                first = min([child.lineno] +
+                    [d.lineno for d in child.decorator_list])
+                block = lines[first - 1:child.lineno - 1] + \
+                    inspect.getblock(lines[child.lineno - 1:])
+                names[first] = names[child.lineno] = qualname
+                hashes[qualname] = hashlib.sha1("".join(block)).hexdigest()
+                visit(child, qualname + ".")
+            else:
+                visit(child, prefix)
+
+    visit(tree, "")
+    hashes["<module>"] = statements(tree.body)
+    return names, hashes
+
+
+def interpreter(filename, path=os.defpath):
+    """Return the command that runs an executable script.
+
+    Returns the interpreter and arguments named on the script's ``#!`` line as
+    a list, with ``env`` resolved the way it would be against *path*. Returns
+    None if the script can't be executed directly.
+
+    :param filename: the path to a script.
+    :param path: the search path for programs, like :envvar:`PATH`.
+    """
+    if not os.access(filename, os.X_OK):
+        return None
+    f = open(filename)
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    if not line.startswith("#!"):
+        return None
+    command = line[2:].split()
+    if command and os.path.basename(command[0]) == "env":
+        command = command[1:]
+        if not command:
+            return None
+        for directory in path.split(os.pathsep):
+            program = os.path.join(directory, command[0])
+            if os.path.isfile(program) and os.access(program, os.X_OK):
+                command[0] = program
+                break
+        else:
+            return None
+    return command or None
+
+
+# Run by the interpreter in functional test subprocesses when coverage is being
+# collected. It executes the script as __main__ and writes the first line number
+# of each of the script's functions that were called to a file, followed by
+# "end" if the script exited normally. Its arguments are the output file, the
+# script and the script's own arguments.
+COVERAGE_BOOTSTRAP = """\
+import atexit
+import sys
+
+out = sys.argv[1]
+sys.argv = sys.argv[2:]
+path = sys.argv[0]
+called = set()
+
+def trace(frame, event, arg):
+    if frame.f_code.co_filename == path:
+        called.add(frame.f_code.co_firstlineno)
+
+def dump():
+    sys.settrace(None)
+    f = open(out, "w")
+    f.write("\\n".join([str(n) for n in sorted(called)] + ["end"]))
+    f.close()
+
+atexit.register(dump)
+code = compile(open(path).read(), path, "exec")
+sys.settrace(trace)
+exec(code, {"__name__": "__main__", "__file__": path})
+"""
+
+
+class Coverage(object):
+    """Record the functions called in a set of source files.
+
+    Calls are recorded by the first line number of the called function's code
+    in :attr:`called`, a dictionary keyed by filename. If some calls couldn't be
+    recorded, :attr:`complete` is set to False.
+
+    :param filenames: paths to the source files to watch.
+    """
+    # The most recently started instance, if any.
+    active = None
+
+    def __init__(self, filenames):
+        self.cwd = os.getcwd()
+        self.filenames = set([os.path.abspath(f) for f in filenames])
+        self.called = {}
+        self.complete = True
+        self._paths = {}
+        self._previous = None
+        self._parent = None
+
+    def trace(self, frame, event, arg):
+        """Record a call; used with :func:`sys.settrace`.
+
+        Calls are passed on to any tracer that was installed before
+        :meth:`start`.
+        """
+        code = frame.f_code
+        try:
+            path = self._paths[code.co_filename]
+        except KeyError:
+            # Resolve relative to the starting directory; functional tests
+            # change the working directory.
+            path = os.path.normpath(os.path.join(self.cwd, code.co_filename))
+            if path not in self.filenames:
+                path = None
+            self._paths[code.co_filename] = path
+        if path is not None:
+            self.called.setdefault(path, set()).add(code.co_firstlineno)
+        if self._previous is not None:
+            return self._previous(frame, event, arg)
+
+    def update(self, filename, linenos):
+        """Record calls to the functions starting at *linenos* in *filename*.
+
+        The calls are also recorded by the instance that was active when this
+        one was started, and so on.
+        """
+        coverage = self
+        while coverage is not None:
+            coverage.called.setdefault(filename, set()).update(linenos)
+            coverage = coverage._parent
+
+    def setincomplete(self):
+        """Mark this instance (and those enclosing it) incomplete."""
+        coverage = self
+        while coverage is not None:
+            coverage.complete = False
+            coverage = coverage._parent
+
+    def start(self):
+        """Start recording calls in the current thread."""
+        self._previous = sys.gettrace()
+        self._parent = Coverage.active
+        Coverage.active = self
+        sys.settrace(self.trace)
+
+    def stop(self):
+        """Stop recording calls and restore the previous tracer."""
+        sys.settrace(self._previous)
+        Coverage.active = self._parent
+        self._previous = None
+        self._parent = None
+
+
+class TestIndex(object):
+    """An index of the functions each passing test calls.
+
+    The index is stored as JSON. It maps test IDs to the hashes (see
+    :func:`sourceblocks`) of the functions each test called when it last
+    passed.
+
+    :param path: the path to the index file.
+    :param filenames: paths to the source files covered by the index.
+    """
+
+    def __init__(self, path, filenames):
+        self.path = path
+        self.sources = {}
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            self.sources[filename] = sourceblocks(filename)
+        self.tests = {}
+        if os.path.exists(path):
+            try:
+                f = open(path)
+                try:
+                    self.tests = dict(json.load(f))
+                finally:
+                    f.close()
+            except (IOError, TypeError, ValueError), e:
+                log.warning("Ignoring unreadable test index %r: %s", path, e)
+
+    def changed(self, test):
+        """Return True if *test* must be run.
+
+        A test must be run if it isn't in the index or if any of the functions
+        it called (or the bodies of their classes or the module) have changed.
+
+        :param test: a test ID.
+        """
+        if test not in self.tests:
+            return True
+        for filename, hashes in self.tests[test].items():
+            if filename not in self.sources:
+                return True
+            current = self.sources[filename][1]
+            for qualname, digest in hashes.items():
+                if current.get(qualname) != digest:
+                    return True
+        return False
+
+    def record(self, test, called, classes=None):
+        """Record the functions called by a passing test.
+
+        :param test: a test ID.
+        :param called: a dictionary mapping filenames to the line numbers of
+            called functions, like :attr:`Coverage.called`.
+        :param classes: a dictionary mapping filenames to the names of classes
+            the test depends on even if it called none of their methods, like
+            the test's own class and its bases.
+        """
+        if classes is None:
+            classes = {}
+        deps = {}
+        for filename, (names, hashes) in self.sources.items():
+            deps[filename] = {"<module>": hashes["<module>"]}
+            for qualname in classes.get(filename, ()):
+                if qualname in hashes:
+                    deps[filename][qualname] = hashes[qualname]
+        for filename, linenos in called.items():
+            names, hashes = self.sources[filename]
+            for lineno in linenos:
+                qualname = names.get(lineno)
+                if qualname is None:
+                    continue
+                # A function also depends on the bodies of the classes (and
+                # functions) that enclose it.
+                parts = qualname.split(".")
+                for i in range(1, len(parts) + 1):
+                    enclosing = ".".join(parts[:i])
+                    if enclosing in hashes:
+                        deps[filename][enclosing] = hashes[enclosing]
+        self.tests[test] = deps
+
+    def discard(self, test):
+        """Forget *test* so that it will be run next time."""
+        self.tests.pop(test, None)
+
+    def prune(self, tests):
+        """Forget tests that no longer exist.
+
+        Tests from the same modules as *tests* that aren't themselves in
+        *tests* are removed. Tests from other modules are kept, since they may
+        share the index.
+
+        :param tests: the test cases that exist.
+        """
+        modules = set([test.__class__.__module__ + "." for test in tests])
+        testids = set([test.id() for test in tests])
+        for testid in list(self.tests):
+            if testid in testids:
+                continue
+            for module in modules:
+                if testid.startswith(module):
+                    del self.tests[testid]
+                    break
+
+    def save(self):
+        """Write the index to :attr:`path`.
+
+        The index is written to a temporary file first and then renamed, so an
+        interrupted run doesn't leave a truncated index.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=name + "-index-", dir=directory)
+        try:
+            f = os.fdopen(fd, "w")
+            try:
+                json.dump(self.tests, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                # Windows can't rename over an existing file.
+                os.remove(self.path)
+                os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+def itertests(suite):
+    """Yield the test cases in a (possibly nested) test suite."""
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for subtest in itertests(test):
+                yield subtest
+        else:
+            yield test
+
+
+def testclasses(test):
+    """Return the classes a test case is made of.
+
+    Returns a dictionary mapping source filenames to the names of the test's
+    class and its bases defined there. A method added to any of them can
+    change the test even if the test never called the method it replaces.
+
+    :param test: a :class:`unittest.TestCase` instance.
+    """
+    classes = {}
+    for cls in inspect.getmro(type(test)):
+        module = sys.modules.get(cls.__module__)
+        filename = getattr(module, "__file__", None)
+        if filename is not None:
+            filename = os.path.abspath(getpyfile(filename))
+            classes.setdefault(filename, []).append(cls.__name__)
+    return classes
+
+
+class IncrementalSuite(unittest.TestSuite):
+    """A test suite that only runs tests affected by source changes.
+
+    Each test is run under :class:`Coverage`. Tests that pass are recorded in a
+    :class:`TestIndex`; tests that fail (or whose coverage is incomplete) are
+    removed from it. Tests that haven't changed according to the index are
+    reported as skipped. The suite is otherwise run as usual, so class and
+    module fixtures still apply.
+
+    :param tests: the tests to run.
+    :param index: the path to the index file.
+    :param filenames: paths to the source files to watch.
+    :param full: if True, run (and record) every test.
+    """
+    reason = "unchanged since last pass"
+
+    def __init__(self, tests=(), index=None, filenames=(), full=False):
+        unittest.TestSuite.__init__(self, tests)
+        self.index = os.path.abspath(index)
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        self.full = full
+
+    def run(self, result):
+        index = TestIndex(self.index, self.filenames)
+        tests = list(itertests(self))
+        for test in tests:
+            if self.full or index.changed(test.id()):
+                test.run = self._covered(test, index)
+            else:
+                log.debug("Skipping unchanged test %s", test.id())
+                test.run = self._skipped(test)
+        try:
+            unittest.TestSuite.run(self, result)
+        finally:
+            for test in tests:
+                del test.run
+        index.prune(tests)
+        index.save()
+        return result
+
+    def _covered(self, test, index):
+        """Return a function that runs *test* and records its coverage."""
+        run = type(test).run
+
+        def covered(result):
+            coverage = Coverage(self.filenames)
+            problems = len(result.failures) + len(result.errors)
+            coverage.start()
+            try:
+                run(test, result)
+            finally:
+                coverage.stop()
+            passed = len(result.failures) + len(result.errors) == problems
+            if passed and coverage.complete:
+                index.record(test.id(), coverage.called, testclasses(test))
+            else:
+                index.discard(test.id())
+        return covered
+
+    def _skipped(self, test):
+        """Return a function that reports *test* as skipped."""
+
+        def skipped(result):
+            result.startTest(test)
+            try:
+                # TestResult.addSkip was added in Python 2.7.
+                addSkip = getattr(result, "addSkip", None)
+                if addSkip is not None:
+                    addSkip(test, self.reason)
+                else:
+                    result.addSuccess(test)
+            finally:
+                result.stopTest(test)
+        return skipped
+
+
+def incremental(tests, filenames, environ=os.environ):
+    """Wrap *tests* in an :class:`IncrementalSuite` if requested.
+
+    Returns *tests* unchanged unless the SCRIPT_TESTINDEX variable is set in
+    *environ*. If SCRIPT_TESTFULL is also set, every test will be run.
+
+    :param tests: a test suite.
+    :param filenames: paths to the source files to watch.
+    :param environ: a dictionary of environment variables,
+        usually :data:`os.environ`.
+    """
+    index = environ.get("SCRIPT_TESTINDEX")
+    if not index:
+        return tests
+    full = bool(environ.get("SCRIPT_TESTFULL"))
+    return IncrementalSuite(tests, index=index, filenames=filenames, full=full)
+
+
+def load_tests(loader, tests, pattern):
+    """Load this script's tests; see :func:`incremental`."""
+    return incremental(tests, [scriptfile])
+
 
 class TestMain(unittest.TestCase):
 
@@ -244,9 +705,15 @@ class TestFunctional(unittest.TestCase):
             after creating the subprocess.
         :param executable: if present, the path to a program to execute instead
             of this script.
+
+        If :class:`Coverage` is active, the functions the script calls are
+        recorded, too.
         """
+        coverage = Coverage.active
+        if "executable" in kwargs:
+            coverage = None
         _kwargs = {
-            "executable": os.path.abspath(getpyfile(__file__)),
+            "executable": scriptfile,
             "stdin": subprocess.PIPE,
             "stdout": subprocess.PIPE,
             "stderr": subprocess.PIPE,
@@ -256,14 +723,47 @@ class TestFunctional(unittest.TestCase):
         _kwargs.update(kwargs)
         kwargs = _kwargs
         args = [kwargs["executable"]] + list(args)
-        log.debug("Creating test process %r, %r", args, kwargs)
-        process = subprocess.Popen(args, **kwargs)
 
-        if communicate is True:
-            stdout, stderr = process.communicate()
-        else:
-            stdout, stderr = None, None
-            self.processes.append(process)
+        # Run the script under COVERAGE_BOOTSTRAP with the interpreter that
+        # would normally run it.
+        tracefile = None
+        if coverage is not None:
+            env = kwargs["env"]
+            if env is None:
+                env = os.environ
+            command = interpreter(scriptfile, env.get("PATH", os.defpath))
+            if command is None or communicate is not True:
+                log.debug("Not collecting coverage from %r", args)
+                coverage.setincomplete()
+            else:
+                fd, tracefile = tempfile.mkstemp(prefix=name + "-coverage-")
+                os.close(fd)
+                args = command + ["-c", COVERAGE_BOOTSTRAP, tracefile] + args
+                kwargs["executable"] = command[0]
+
+        try:
+            log.debug("Creating test process %r, %r", args, kwargs)
+            process = subprocess.Popen(args, **kwargs)
+
+            if communicate is True:
+                stdout, stderr = process.communicate()
+            else:
+                stdout, stderr = None, None
+                self.processes.append(process)
+
+            if tracefile is not None:
+                f = open(tracefile)
+                try:
+                    lines = f.read().split()
+                finally:
+                    f.close()
+                if lines[-1:] != ["end"]:
+                    coverage.setincomplete()
+                coverage.update(scriptfile,
+                    [int(l) for l in lines if l != "end"])
+        finally:
+            if tracefile is not None:
+                os.remove(tracefile)
 
         return process, stdout, stderr
 
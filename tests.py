@@ -1,8 +1,18 @@
 import logging
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 from StringIO import StringIO
 
+def load_tests(loader, tests, pattern):
+    import script
+
+    filenames = [script.getpyfile(__file__), script.scriptfile]
+    return script.incremental(tests, filenames)
+
 class FakeProcess(object):
 
     def kill(self):
@@ -130,3 +140,268 @@ class TestFunctionalTests(unittest.TestCase):
         self.functest.processes.append(self.proc)
 
         self.assertRaises(OSError, self.functest.tearDown)
+
+class TestCoverage(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        import script
+
+        self.script = script
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source.py")
+        self.index = os.path.join(self.tmpdir, "index")
+        self.write("import sys\n\ndef foo():\n    return 1\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, source):
+        f = open(self.source, "w")
+        f.write(source)
+        f.close()
+
+    def test_sourceblocks(self):
+        names, hashes = self.script.sourceblocks(self.source)
+
+        self.assertEqual(names, {3: "foo", 7: "Bar.baz"})
+        self.assertEqual(sorted(hashes), ["<module>", "Bar", "Bar.baz", "foo"])
+
+    def test_sourceblocks_changed(self):
+        names, before = self.script.sourceblocks(self.source)
+        self.write("import sys\n\ndef foo():\n    return 3\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n")
+        names, after = self.script.sourceblocks(self.source)
+
+        self.assertNotEqual(before["foo"], after["foo"])
+        self.assertEqual(before["Bar.baz"], after["Bar.baz"])
+        self.assertEqual(before["<module>"], after["<module>"])
+
+    def test_sourceblocks_layout(self):
+        names, before = self.script.sourceblocks(self.source)
+        self.write("import sys\n\n# A comment.\n\ndef foo():\n    return 1\n\n"
+            "class Bar(object):\n\n    def baz(self):\n        return 2\n")
+        names, after = self.script.sourceblocks(self.source)
+
+        self.assertEqual(before["<module>"], after["<module>"])
+        self.assertEqual(before["Bar"], after["Bar"])
+        self.assertEqual(before["foo"], after["foo"])
+
+    def test_sourceblocks_newdefs(self):
+        names, before = self.script.sourceblocks(self.source)
+        self.write("import sys\n\ndef foo():\n    return 1\n\n"
+            "def new():\n    pass\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n"
+            "    def new(self):\n        pass\n")
+        names, after = self.script.sourceblocks(self.source)
+
+        self.assertNotEqual(before["<module>"], after["<module>"])
+        self.assertNotEqual(before["Bar"], after["Bar"])
+        self.assertEqual(before["Bar.baz"], after["Bar.baz"])
+
+    def test_index(self):
+        index = self.script.TestIndex(self.index, [self.source])
+        self.assertTrue(index.changed("test"))
+
+        index.record("test", {self.source: set([7])})
+        index.save()
+        self.write("import sys\n\ndef foo():\n    return 3\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n")
+        index = self.script.TestIndex(self.index, [self.source])
+        self.assertFalse(index.changed("test"))
+
+        self.write("import sys\n\ndef foo():\n    return 3\n\n"
+            "class Bar(object):\n    x = 1\n    def baz(self):\n"
+            "        return 2\n")
+        index = self.script.TestIndex(self.index, [self.source])
+        self.assertTrue(index.changed("test"))
+
+        self.write("import os\n\ndef foo():\n    return 3\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n")
+        index = self.script.TestIndex(self.index, [self.source])
+        self.assertTrue(index.changed("test"))
+
+    def test_index_newmethod(self):
+        index = self.script.TestIndex(self.index, [self.source])
+        index.record("test", {self.source: set([7])})
+        index.save()
+        self.write("import sys\n\ndef foo():\n    return 1\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n"
+            "    def setUp(self):\n        pass\n")
+        index = self.script.TestIndex(self.index, [self.source])
+
+        self.assertTrue(index.changed("test"))
+
+    def test_index_classes(self):
+        index = self.script.TestIndex(self.index, [self.source])
+        index.record("test", {}, {self.source: ["Bar"]})
+        index.save()
+        self.write("import sys\n\ndef foo():\n    return 1\n\n"
+            "class Bar(object):\n    def baz(self):\n        return 2\n"
+            "    def qux(self):\n        pass\n")
+        index = self.script.TestIndex(self.index, [self.source])
+
+        self.assertTrue(index.changed("test"))
+
+    def test_index_unreadable(self):
+        f = open(self.index, "w")
+        f.write("{bad")
+        f.close()
+        index = self.script.TestIndex(self.index, [self.source])
+
+        self.assertEqual(index.tests, {})
+        self.assertTrue(index.changed("test"))
+
+    def test_index_prune(self):
+        index = self.script.TestIndex(self.index, [self.source])
+        index.record(self.id(), {})
+        index.record(__name__ + ".TestCoverage.test_gone", {})
+        index.record("other.Test.test_other", {})
+        index.prune([self])
+        index.save()
+        index = self.script.TestIndex(self.index, [self.source])
+
+        self.assertEqual(sorted(index.tests),
+            sorted([self.id(), "other.Test.test_other"]))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["index", "source.py"])
+
+    def test_index_discard(self):
+        index = self.script.TestIndex(self.index, [self.source])
+        index.record("test", {})
+        index.discard("test")
+
+        self.assertTrue(index.changed("test"))
+
+    def test_incremental(self):
+        tests = unittest.TestSuite()
+
+        self.assertTrue(self.script.incremental(tests, [], environ={}) is tests)
+        suite = self.script.incremental(tests, [self.source],
+            environ={"SCRIPT_TESTINDEX": self.index, "SCRIPT_TESTFULL": "1"})
+        self.assertTrue(isinstance(suite, self.script.IncrementalSuite))
+        self.assertEqual(suite.full, True)
+
+    def runsuite(self, test, full=False):
+        suite = unittest.TestLoader().loadTestsFromTestCase(test)
+        suite = self.script.IncrementalSuite([suite], index=self.index,
+            filenames=[self.source], full=full)
+        return suite.run(unittest.TestResult())
+
+    def test_incrementalsuite(self):
+        calls = []
+        class Test(unittest.TestCase):
+            def test_pass(self):
+                calls.append("pass")
+            def test_fail(self):
+                calls.append("fail")
+                self.fail()
+
+        self.runsuite(Test)
+        result = self.runsuite(Test)
+        self.assertEqual(sorted(calls), ["fail", "fail", "pass"])
+        self.assertEqual(result.testsRun, 2)
+        self.assertEqual(len(result.skipped), 1)
+        self.assertEqual(result.skipped[0][1], "unchanged since last pass")
+
+        result = self.runsuite(Test, full=True)
+        self.assertEqual(sorted(calls), ["fail", "fail", "fail", "pass", "pass"])
+        self.assertEqual(result.skipped, [])
+
+    def test_incrementalsuite_fixtures(self):
+        calls = []
+        class Test(unittest.TestCase):
+            @classmethod
+            def setUpClass(cls):
+                cls.fixture = True
+            @classmethod
+            def tearDownClass(cls):
+                calls.append("tearDownClass")
+            def test_fixture(self):
+                self.assertTrue(self.fixture)
+
+        result = self.runsuite(Test)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(calls, ["tearDownClass"])
+
+    def test_coverage_nested(self):
+        filename = self.script.getpyfile(__file__)
+        outer = self.script.Coverage([filename])
+        inner = self.script.Coverage([filename])
+        def called():
+            pass
+
+        outer.start()
+        try:
+            inner.start()
+            try:
+                called()
+            finally:
+                inner.stop()
+            self.assertEqual(sys.gettrace(), outer.trace)
+        finally:
+            outer.stop()
+        lineno = called.__code__.co_firstlineno
+
+        self.assertTrue(lineno in inner.called[os.path.abspath(filename)])
+        self.assertTrue(lineno in outer.called[os.path.abspath(filename)])
+
+    def test_interpreter(self):
+        bindir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(bindir)
+        python = os.path.join(bindir, "python")
+        open(python, "w").close()
+        os.chmod(python, 0755)
+        interpreter = self.script.interpreter
+
+        self.assertEqual(interpreter(self.source, bindir), None)
+        os.chmod(self.source, 0755)
+        self.assertEqual(interpreter(self.source, bindir), None)
+        self.write("#!/usr/bin/env python\n")
+        self.assertEqual(interpreter(self.source, bindir), [python])
+        self.assertEqual(interpreter(self.source, self.tmpdir), None)
+        self.write("#!/bin/sh -e\n")
+        self.assertEqual(interpreter(self.source, bindir), ["/bin/sh", "-e"])
+
+    def functest(self, *args, **kwargs):
+        class TestFunctional(self.script.TestFunctional):
+            def runTest(self):
+                pass
+        functest = TestFunctional()
+        coverage = self.script.Coverage([self.script.scriptfile])
+        functest.setUp()
+        coverage.start()
+        try:
+            proc, stdout, stderr = functest.sub(*args, **kwargs)
+        finally:
+            coverage.stop()
+            functest.tearDown()
+        return coverage, proc
+
+    def test_sub(self):
+        filename = self.script.scriptfile
+        coverage, proc = self.functest("-h")
+        names, hashes = self.script.sourceblocks(filename)
+
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(coverage.complete)
+        called = [names.get(n) for n in coverage.called[filename]]
+        self.assertTrue("parseargs" in called)
+        self.assertTrue("main" in called)
+
+    def test_sub_noenv(self):
+        coverage, proc = self.functest("-h", env=None)
+        names, hashes = self.script.sourceblocks(self.script.scriptfile)
+
+        called = [names.get(n) for n in coverage.called[self.script.scriptfile]]
+        self.assertTrue("main" in called)
+
+    def test_sub_nocommunicate(self):
+        coverage, proc = self.functest("-h", communicate=False)
+
+        names, hashes = self.script.sourceblocks(self.script.scriptfile)
+
+        self.assertFalse(coverage.complete)
+        called = [names.get(n) for n in coverage.called[self.script.scriptfile]]
+        self.assertFalse("main" in called)